@@ -1,9 +1,26 @@
-import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from zoneinfo import ZoneInfo
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
-from datetime import datetime, timezone
-from dateutil import tz
 import streamlit as st
 
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
 # =========================== CONFIG ===========================
 TOP_N = 50
 PER_PAGE = 250
@@ -21,7 +38,21 @@ KNOWN_STABLE_SYMS = {
     "usdt","usdc","dai","frax","fdusd","tusd","usdp","busd","gusd","lusd","usdd","susd","usde","pyusd"
 }
 
+# Combined exclusion sets used by the universe filter
+_EXCL_IDS = frozenset(EXCLUDE_IDS | KNOWN_STABLE_IDS)
+_EXCL_SYMS = frozenset(EXCLUDE_SYMS | KNOWN_STABLE_SYMS)
+
+# Only these /coins/markets fields are used; the rest are dropped right after parsing
+CG_KEEP_FIELDS = (
+    "id", "symbol", "name", "current_price", "market_cap",
+    "price_change_percentage_24h", "price_change_percentage_7d_in_currency",
+)
+
+PK_TZ = ZoneInfo("Asia/Karachi")
+
 CG_BASE = "https://api.coingecko.com/api/v3"
+CACHE_TTL = 60  # seconds; shared by the data caches and the table refresh timer
+CG_MAX_PER_PAGE = 250  # API-side limit for /coins/markets
 
 # Optional future scenario overrides (static text, not live data)
 SCENARIO_OVERRIDES = {
@@ -39,27 +70,111 @@ SCENARIO_OVERRIDES = {
     "cosmos":       ("25",     "8–15",          "3–6"),
 }
 
+# Multipliers for the default (non-override) 2026 scenarios
+BULL_MULT, BASE_MULT, BEAR_MULT = 2.5, 1.5, 0.6
+
+# Client-side throttle: stay under CoinGecko's free-tier cap (~10-30 req/min)
+CG_TOKENS_PER_MIN = 25
+CG_RETRY_STATUSES = {429, 502, 503, 504}
+CG_MAX_ATTEMPTS = 3
+CG_MAX_RETRY_WAIT = 10  # seconds; caps Retry-After and backoff sleeps
+
+class _TokenBucket:
+    def __init__(self, tokens_per_min):
+        self.capacity = float(tokens_per_min)
+        self.rate = tokens_per_min / 60.0
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            wait = (1.0 - self.tokens) / self.rate if self.tokens < 1.0 else 0.0
+            self.tokens -= 1.0
+        if wait > 0:
+            time.sleep(wait)
+
+    def drain(self):
+        with self.lock:
+            self.tokens = min(self.tokens, 0.0)
+
 # =========================== HELPERS ===========================
+# Streamlit re-executes this script on every rerun, so the HTTP session and the
+# throttle live in cache_resource to survive reruns (and be shared by sessions).
+@st.cache_resource
+def get_session():
+    # Shared HTTP session (keep-alive + connection pooling across reruns)
+    session = Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=20,
+        # only connection failures (never reached the API) are retried here;
+        # status-based retries happen in cg_get so each one spends a token
+        max_retries=Retry(connect=2, read=0, status=0, backoff_factor=0.5),
+    ))
+    session.headers.update({
+        "User-Agent": "crypto-market-report/1.0",
+        "Accept": "application/json",
+    })
+    # gzip/deflate always; br (or zstd) only when a decoder is installed
+    session.headers.update(make_headers(accept_encoding=True))
+    return session
+
+@st.cache_resource
+def get_bucket():
+    return _TokenBucket(CG_TOKENS_PER_MIN)
+
+def _retry_wait(r, attempt):
+    try:
+        wait = float(r.headers.get("Retry-After", ""))
+    except ValueError:
+        wait = 2 ** attempt
+    return min(max(wait, 0.0), CG_MAX_RETRY_WAIT)
+
+def cg_get(url, params):
+    # Every attempt, retries included, takes a token from the bucket.
+    # Worst case per call (ignoring bucket waits): 3 attempts x 30s read timeout
+    # + 2 retry sleeps x 10s = ~110s before the error surfaces.
+    bucket = get_bucket()
+    for attempt in range(CG_MAX_ATTEMPTS):
+        bucket.take()
+        r = get_session().get(url, params=params, timeout=30)
+        if r.status_code == 429 or r.headers.get("X-RateLimit-Remaining") == "0":
+            bucket.drain()
+        if r.status_code not in CG_RETRY_STATUSES or attempt == CG_MAX_ATTEMPTS - 1:
+            break
+        time.sleep(_retry_wait(r, attempt))
+    r.raise_for_status()
+    return r
+
+def cg_get_coins(url, params):
+    data = _loads(cg_get(url, params).content)
+    return [{k: c.get(k) for k in CG_KEEP_FIELDS} for c in data]
+
 def looks_stable_like(price, ch24, ch7d):
-    if price is None:
+    if price is None or not (0.95 <= price <= 1.05):
         return False
-    near_one = 0.95 <= price <= 1.05
-    low_vol = True
-    try:
-        if ch24 is not None and ch7d is not None:
-            low_vol = abs(ch24) < 2.5 and abs(ch7d) < 4.0
-    except Exception:
-        pass
-    return near_one and low_vol
+    if ch24 is None or ch7d is None:
+        return True
+    return abs(ch24) < 2.5 and abs(ch7d) < 4.0
 
 def default_scenarios(curr_price):
     if curr_price is None or curr_price <= 0:
         return ("—","—","—")
-    bull = f"{curr_price*2.5:,.2f}"
-    base = f"{curr_price*1.5:,.2f}"
-    bear = f"{curr_price*0.6:,.2f}"
+    # key on a rounded price so ulp-level float noise still hits the cache
+    return _scenario_strings(round(curr_price, 8))
+
+@lru_cache(maxsize=256)
+def _scenario_strings(curr_price):
+    bull = f"{curr_price*BULL_MULT:,.2f}"
+    base = f"{curr_price*BASE_MULT:,.2f}"
+    bear = f"{curr_price*BEAR_MULT:,.2f}"
     return (bull, base, bear)
 
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
 def cg_get_markets(vs="usd", per_page=250, page=1):
     url = f"{CG_BASE}/coins/markets"
     params = {
@@ -70,71 +185,91 @@ def cg_get_markets(vs="usd", per_page=250, page=1):
         "price_change_percentage": "24h,7d",
         "sparkline": "false",
     }
-    r = requests.get(url, params=params, timeout=30)
-    r.raise_for_status()
-    return r.json()
+    return cg_get_coins(url, params)
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def cg_get_markets_by_ids(ids, vs="usd"):
+    # CoinGecko caps per_page at 250, so look ids up in batches of at most that
+    url = f"{CG_BASE}/coins/markets"
+    coins = []
+    for start in range(0, len(ids), CG_MAX_PER_PAGE):
+        batch = ids[start:start + CG_MAX_PER_PAGE]
+        params = {
+            "vs_currency": vs,
+            "ids": ",".join(batch),
+            "per_page": len(batch),
+            "page": 1,
+            "price_change_percentage": "24h,7d",
+            "sparkline": "false",
+        }
+        coins.extend(cg_get_coins(url, params))
+    return coins
 
 def pick_universe():
     # Optionally support INCLUDE_ONLY
     if INCLUDE_ONLY:
-        markets = {}
-        page = 1
-        while len(markets) < len(INCLUDE_ONLY) and page <= 4:
-            for c in cg_get_markets(vs=VS_CCY, per_page=PER_PAGE, page=page):
-                markets[c["id"]] = c
-            page += 1
+        markets = {c["id"]: c for c in cg_get_markets_by_ids(INCLUDE_ONLY, vs=VS_CCY)}
         return [markets[i] for i in INCLUDE_ONLY if i in markets]
 
-    markets = cg_get_markets(vs=VS_CCY, per_page=PER_PAGE, page=1)
-    markets.sort(key=lambda x: (x.get("market_cap") or 0), reverse=True)
+    # Only the first TOP_N*2 rows are ever considered, so don't download more
+    # (order=market_cap_desc: the API response is already sorted, no need to re-sort)
+    markets = cg_get_markets(vs=VS_CCY, per_page=min(PER_PAGE, TOP_N*2), page=1)
 
-    picked = []
-    for c in markets[:TOP_N*2]:  # grab extra to allow removals
+    def keep(c):
         cid = c.get("id","")
         sym = (c.get("symbol") or "").lower()
-        name = (c.get("name") or "").lower()
-        price = c.get("current_price")
-        ch24  = c.get("price_change_percentage_24h")
-        ch7d  = c.get("price_change_percentage_7d_in_currency")
-
-        if cid in EXCLUDE_IDS or sym in EXCLUDE_SYMS:          continue
-        if cid in KNOWN_STABLE_IDS or sym in KNOWN_STABLE_SYMS: continue
-        if looks_stable_like(price, ch24, ch7d) and ("usd" in sym or "usd" in name):
-            continue
+        if cid in _EXCL_IDS or sym in _EXCL_SYMS:
+            return False
+        if looks_stable_like(c.get("current_price"),
+                             c.get("price_change_percentage_24h"),
+                             c.get("price_change_percentage_7d_in_currency")):
+            name = (c.get("name") or "").lower()
+            if "usd" in sym or "usd" in name:
+                return False
+        return True
 
-        picked.append(c)
-        if len(picked) >= TOP_N:
-            break
+    # markets already holds at most TOP_N*2 rows (extra to allow removals)
+    picked = list(islice((c for c in markets if keep(c)), TOP_N))
     return picked
 
 # =========================== DATA (CACHED) ===========================
-@st.cache_data(ttl=60)  # cache for up to 60 seconds unless user presses Refresh
+# cache for up to CACHE_TTL seconds unless user presses Refresh; no spinner since
+# this also runs on the background refresh thread, outside the script context
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
 def fetch_data():
     universe = pick_universe()
-    rows = []
-    for i, c in enumerate(universe, 1):
-        cid    = c.get("id")
-        name   = c.get("name")
-        sym    = (c.get("symbol") or "").upper()
-        price  = c.get("current_price")
-        ch24   = c.get("price_change_percentage_24h")
-        mcap   = c.get("market_cap")
-
-        bull, base, bear = SCENARIO_OVERRIDES.get(cid, default_scenarios(price))
-
-        rows.append({
-            "Rank": i,
-            "Sym": sym,
-            "Name": name,
-            "Live USD": price,
-            "24h %": ch24,
-            "Market Cap": mcap,
-            "2026 Bull": bull,
-            "2026 Base": base,
-            "2026 Bear": bear,
-        })
-    df = pd.DataFrame(rows).sort_values("Rank")
-    return df
+    syms, names, prices, ch24s, mcaps = [], [], [], [], []
+    bulls, bases, bears = [], [], []
+    for c in universe:
+        price = c.get("current_price")
+        # defaults are only computed for coins without an override
+        scen = SCENARIO_OVERRIDES.get(c.get("id"))
+        bull, base, bear = scen if scen is not None else default_scenarios(price)
+
+        syms.append((c.get("symbol") or "").upper())
+        names.append(c.get("name"))
+        prices.append(price)
+        ch24s.append(c.get("price_change_percentage_24h"))
+        mcaps.append(c.get("market_cap"))
+        bulls.append(bull)
+        bases.append(base)
+        bears.append(bear)
+
+    # Column-wise build with narrow dtypes; universe is already in rank order.
+    # Sym is low-cardinality -> category; free text -> Arrow-backed strings.
+    df = pd.DataFrame({
+        "Rank":       pd.to_numeric(np.arange(1, len(universe) + 1), downcast="unsigned"),
+        "Sym":        pd.Categorical(syms),
+        "Name":       pd.array(names, dtype="string[pyarrow]"),
+        "Live USD":   np.asarray(prices, dtype=np.float64),
+        "24h %":      np.asarray(ch24s, dtype=np.float32),
+        "Market Cap": np.asarray(mcaps, dtype=np.float64),
+        "2026 Bull":  pd.array(bulls, dtype="string[pyarrow]"),
+        "2026 Base":  pd.array(bases, dtype="string[pyarrow]"),
+        "2026 Bear":  pd.array(bears, dtype="string[pyarrow]"),
+    })
+    # stamped here so cache hits keep reporting when the data was actually fetched
+    return df, datetime.now(PK_TZ)
 
 # =========================== UI ===========================
 st.set_page_config(page_title="Crypto Market Report", layout="wide")
@@ -143,27 +278,47 @@ st.title("📊 Auto Crypto Market Report (Live Prices)")
 # Refresh button (fixed for Streamlit >=1.30)
 if st.button("🔄 Refresh Data"):
     try:
-        st.cache_data.clear()   # ensure fresh API calls
+        # ensure fresh API calls; leave unrelated cached entries alone
+        cg_get_markets.clear()
+        cg_get_markets_by_ids.clear()
+        fetch_data.clear()
     except Exception:
         pass
+    # drop the warm copy so this run blocks on genuinely fresh data
+    st.session_state.pop("last_df", None)
+    st.session_state.pop("last_fetched", None)
+    st.session_state.pop("refresh_future", None)
+    st.session_state.pop("refresh_error", None)
     st.rerun()
 
-# Timestamp (PKT)
-pk_tz = tz.gettz("Asia/Karachi")
-now_str = datetime.now(timezone.utc).astimezone(pk_tz).strftime("%Y-%m-%d %H:%M %Z")
-st.caption(f"Last updated: {now_str}")
-
 # Display landing page link
 landing_page_url = "https://manzoorshoro.github.io/crypto-market-report"  # Replace with your actual GitHub Pages URL
-st.markdown(f"### Welcome to the Crypto Market Report app!")
+st.markdown("### Welcome to the Crypto Market Report app!")
 st.markdown(f"Click here to visit the [Landing Page]({landing_page_url})")
 
-# Fetch + show
-try:
-    df = fetch_data()
-except Exception as e:
-    st.error(f"Failed to fetch data from CoinGecko: {e}")
-    st.stop()
+# Fetch: only the very first load blocks; afterwards the last good frame is shown
+# immediately while a background worker refreshes it.
+def _maybe_refresh_async():
+    state = st.session_state
+    if "refresh_pool" not in state:
+        state["refresh_pool"] = ThreadPoolExecutor(max_workers=1)
+    fut = state.get("refresh_future")
+    if fut is None:
+        state["refresh_future"] = state["refresh_pool"].submit(fetch_data)
+    elif fut.done():
+        state["refresh_future"] = None
+        try:
+            state["last_df"], state["last_fetched"] = fut.result()
+            state.pop("refresh_error", None)
+        except Exception as e:
+            state["refresh_error"] = e  # API outage: keep the last known good data
+
+if "last_df" not in st.session_state:
+    try:
+        st.session_state["last_df"], st.session_state["last_fetched"] = fetch_data()
+    except Exception as e:
+        st.error(f"Failed to fetch data from CoinGecko: {e}")
+        st.stop()
 
 # Pretty formatting for display
 def fmt_price(x):
@@ -175,11 +330,29 @@ def fmt_price(x):
     elif ax >= 0.000001: return f"${x:,.8f}"
     else:                return f"${x:.2e}"
 
-df_display = df.copy()
-df_display["Live USD"]  = df_display["Live USD"].map(lambda x: fmt_price(x) if pd.notna(x) else "—")
-df_display["24h %"]     = df_display["24h %"].map(lambda x: f"{x:+.2f}%" if pd.notna(x) else "—")
-df_display["Market Cap"]= df_display["Market Cap"].map(lambda x: f"${x:,.0f}" if pd.notna(x) else "—")
+# Format at the display layer only: numeric dtypes survive, so UI column sorting works
+fmt = {
+    "Live USD":   fmt_price,
+    "24h %":      "{:+.2f}%",
+    "Market Cap": "${:,.0f}",
+}
+
+# Only this fragment re-runs on the timer; fetch_data's cache keeps it from
+# hitting the API more than once per TTL. A refresh is submitted on one tick and
+# collected on the next, so shown data is at most CACHE_TTL + 2 ticks (90s) old.
+TABLE_REFRESH_EVERY = CACHE_TTL // 4
+
+@st.fragment(run_every=TABLE_REFRESH_EVERY)
+def render_table():
+    _maybe_refresh_async()
+    state = st.session_state
+    # Timestamp (PKT) of the data actually on screen, not of this rerun
+    st.caption(f"Last updated: {state['last_fetched'].strftime('%Y-%m-%d %H:%M %Z')}")
+    if "refresh_error" in state:
+        st.warning(f"Showing stale data: refresh from CoinGecko failed: {state['refresh_error']}")
+    df = state["last_df"]
+    st.dataframe(df.style.format(fmt, na_rep="—"), use_container_width=True)
 
-st.dataframe(df_display, use_container_width=True)
+render_table()
 
 